@@ -1,56 +1,268 @@
 import os
+import logging
+import logging.handlers
 import httpx
+import orjson
 import asyncio
-import platform
-import traceback
-import subprocess
-import threading
 import queue
+import re
+import subprocess
+import time
+import hashlib
+import itertools
+from urllib.parse import urlencode
+from collections import defaultdict, deque
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
 import streamlink # Importação essencial para o Streamlink
+from contextlib import asynccontextmanager
 
-from dotenv import load_dotenv
+# uvloop acelera o event loop (HTTP, subprocessos do FFmpeg); não existe no Windows
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
-from fastapi import FastAPI, Request, HTTPException, status, Body
-from fastapi.responses import RedirectResponse, JSONResponse
+from fastapi import FastAPI, Request, Response, HTTPException, status, Body, Depends
+from fastapi.responses import RedirectResponse, ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from starlette.middleware.sessions import SessionMiddleware
+from fastapi.security import OAuth2PasswordBearer
+from jose import jwt, JWTError
 from pydantic import BaseModel
+from pydantic_settings import BaseSettings, SettingsConfigDict
+from slowapi import Limiter, _rate_limit_exceeded_handler
+from slowapi.errors import RateLimitExceeded
+from slowapi.util import get_remote_address
+
+logger = logging.getLogger(__name__)
+
+# --- CONFIGURAÇÕES (lidas uma única vez do ambiente / arquivo .env) ---
+class Settings(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_file=os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env"),
+        extra="ignore",
+    )
 
-# Carrega variáveis de ambiente do arquivo .env
-load_dotenv()
+    twitch_client_id: str | None = None
+    twitch_client_secret: str | None = None
+    twitch_redirect_uri: str = "http://localhost:5000/api/auth/callback"
+    secret_key: str = 'uma_chave_secreta_padrao_muito_longa_e_complexa_e_aleatoria_para_fins_de_desenvolvimento_apenas'
+    frontend_url: str = "http://localhost:5173"
+    # Certifique-se de que estes caminhos estão ABSOLUTOS e CORRETOS no seu .env
+    ffmpeg_path: str = 'ffmpeg'
+    streamlink_path: str = 'streamlink'
+    # FFMPEG_LOG=1 registra toda a saída do FFmpeg; com 0 ela só é lida para acompanhar o VOD atual
+    ffmpeg_log: bool = False
+    # APP_DEBUG_ENV=1 registra as configurações carregadas na inicialização
+    app_debug_env: bool = False
+
+settings = Settings()
+
+# --- LOGGING ---
+def start_log_listener() -> logging.handlers.QueueListener:
+    """Direciona o logging para uma fila; a escrita no terminal acontece em uma thread separada."""
+    # Assim as corrotinas do event loop só enfileiram registros e nunca bloqueiam em I/O de log
+    log_queue = queue.Queue(-1)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    root_logger = logging.getLogger()
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    root_logger.setLevel(logging.INFO)
+    # DEBUG só para o logger desta aplicação: no DEBUG o hpack registra os cabeçalhos HTTP/2,
+    # incluindo o "authorization: Bearer ..." dos tokens da Twitch
+    logger.setLevel(logging.DEBUG if settings.app_debug_env else logging.INFO)
+    # httpx/httpcore registram cada requisição em INFO; o polling do dashboard encheria o log
+    for noisy_logger in ("httpx", "httpcore", "hpack"):
+        logging.getLogger(noisy_logger).setLevel(logging.WARNING)
+
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+def stop_log_listener(listener: logging.handlers.QueueListener):
+    listener.stop()
+    root_logger = logging.getLogger()
+    for handler in root_logger.handlers[:]:
+        if isinstance(handler, logging.handlers.QueueHandler) and handler.queue is listener.queue:
+            root_logger.removeHandler(handler)
+
+def log_settings():
+    """CÓDIGO DE DEBUG (para verificar o .env): só roda com APP_DEBUG_ENV=1."""
+    logger.debug("--- DEBUG DE VARIÁVEIS DE AMBIENTE ---")
+    logger.debug("TWITCH_CLIENT_ID: '%s'", settings.twitch_client_id)
+    # Segredos não são registrados, apenas se estão configurados
+    logger.debug("TWITCH_CLIENT_SECRET configurado: %s", bool(settings.twitch_client_secret))
+    logger.debug("TWITCH_REDIRECT_URI: '%s'", settings.twitch_redirect_uri)
+    logger.debug("SECRET_KEY configurado: %s", "secret_key" in settings.model_fields_set)
+    logger.debug("FFMPEG_PATH: '%s'", settings.ffmpeg_path)
+    logger.debug("STREAMLINK_PATH: '%s'", settings.streamlink_path)
+    logger.debug("FFMPEG_LOG: %s", settings.ffmpeg_log)
+    logger.debug("--- FIM DO DEBUG ---")
+
+# --- CLIENTE HTTP COMPARTILHADO ---
+# Um único AsyncClient para toda a aplicação: reaproveita conexões keep-alive com
+# id.twitch.tv / api.twitch.tv em vez de refazer o handshake TCP+TLS a cada requisição.
+# Criado sob demanda, para funcionar também quando o lifespan não roda (ex.: testes)
+http_client: httpx.AsyncClient | None = None
+_http_client_lock = asyncio.Lock()
+
+def create_http_client() -> httpx.AsyncClient:
+    # http2=True permite multiplexar várias chamadas à Helix em uma única conexão (requer o pacote h2)
+    # O Client-ID vai em todas as chamadas à Twitch; o Authorization é passado por chamada
+    return httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=30),
+        timeout=httpx.Timeout(10.0, connect=5.0),
+        headers={"Client-ID": settings.twitch_client_id or ""},
+    )
 
-# --- CÓDIGO DE DEBUG (manter para verificar .env) ---
-print("--- DEBUG DE VARIÁVEIS DE AMBIENTE ---")
-print(f"Valor de TWITCH_CLIENT_ID no .env: '{os.getenv('TWITCH_CLIENT_ID')}'")
-print(f"Valor de TWITCH_CLIENT_SECRET no .env: '{os.getenv('TWITCH_CLIENT_SECRET')}'")
-print(f"Valor de TWITCH_REDIRECT_URI no .env: '{os.getenv('TWITCH_REDIRECT_URI')}'")
-print(f"Valor de SECRET_KEY no .env: '{os.getenv('SECRET_KEY')}'")
-print(f"Valor de FFMPEG_PATH no .env: '{os.getenv('FFMPEG_PATH')}'")
-print(f"Valor de STREAMLINK_PATH no .env: '{os.getenv('STREAMLINK_PATH')}'")
-print("--- FIM DO DEBUG ---")
+async def get_http_client() -> httpx.AsyncClient:
+    global http_client
+    if http_client is None or http_client.is_closed:
+        # O lock garante que requisições simultâneas criem um único cliente
+        async with _http_client_lock:
+            if http_client is None or http_client.is_closed:
+                http_client = create_http_client()
+    return http_client
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global http_client
+    log_listener = start_log_listener()
+    if settings.app_debug_env:
+        log_settings()
+    # Também fica disponível em app.state para quem só tem acesso à aplicação
+    app.state.http = await get_http_client()
+    try:
+        yield
+    finally:
+        # Encerra as transmissões em andamento antes de fechar o servidor
+        await stop_all_streams()
+        if http_client is not None:
+            await http_client.aclose()
+            http_client = None
+        stop_log_listener(log_listener)
 
-app = FastAPI()
+# ORJSONResponse como padrão: serialização bem mais rápida da lista de VODs
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # --- Configurações de Ambiente ---
-CLIENT_ID = os.getenv('TWITCH_CLIENT_ID')
-CLIENT_SECRET = os.getenv('TWITCH_CLIENT_SECRET')
-REDIRECT_URI = os.getenv('TWITCH_REDIRECT_URI', "http://localhost:5000/api/auth/callback")
-SECRET_KEY = os.getenv('SECRET_KEY', 'uma_chave_secreta_padrao_muito_longa_e_complexa_e_aleatoria_para_fins_de_desenvolvimento_apenas')
+CLIENT_ID = settings.twitch_client_id
+CLIENT_SECRET = settings.twitch_client_secret
+REDIRECT_URI = settings.twitch_redirect_uri
+SECRET_KEY = settings.secret_key
+
+# --- URLs PRÉ-CALCULADAS ---
+TWITCH_TOKEN_URL = "https://id.twitch.tv/oauth2/token"
+# A URL de autorização só depende de configuração estática, então é montada uma vez na carga
+TWITCH_SCOPES = "user:read:email user:read:broadcast"
+# None quando o CLIENT_ID não está configurado (a rota de login responde com erro)
+TWITCH_AUTH_URL = "https://id.twitch.tv/oauth2/authorize?" + urlencode({
+    "client_id": CLIENT_ID,
+    "redirect_uri": REDIRECT_URI or "",
+    "response_type": "code",
+    "scope": TWITCH_SCOPES,
+}) if CLIENT_ID else None
+
+# Placeholder de dimensões nas thumbnails da Helix e o tamanho usado no dashboard
+THUMBNAIL_SIZE_PLACEHOLDER = "%{width}x%{height}"
+THUMBNAIL_SIZE = "320x180"
+
+FRONTEND_URL = settings.frontend_url
+FRONTEND_LOGIN_URL = f"{FRONTEND_URL}/login?"
+FRONTEND_DASHBOARD_URL = f"{FRONTEND_URL}/dashboard?"
 
 # --- CONFIGURAÇÃO PARA FERRAMENTAS EXTERNAS ---
-# Certifique-se de que estes caminhos estão ABSOLUTOS e CORRETOS no seu .env
-FFMPEG_PATH = os.getenv('FFMPEG_PATH', 'ffmpeg')
-STREAMLINK_PATH = os.getenv('STREAMLINK_PATH', 'streamlink')
-
-# Dicionários globais para gerenciar streams e status
-# Chave: user_id, Valor: subprocess.Popen (objeto do processo FFmpeg)
-active_streams = {}
-# Chave: user_id, Valor: dict com status e current_vod
-user_stream_status = {} # Para manter o status da stream por usuário
-
-# Fila para VODs (se você quiser mais de um VOD em sequência)
-# Chave: user_id, Valor: queue.Queue()
-user_vod_queues = {}
+FFMPEG_PATH = settings.ffmpeg_path
+STREAMLINK_PATH = settings.streamlink_path
+FFMPEG_LOG = settings.ffmpeg_log
+
+# Estado de transmissão de cada usuário, num único objeto. Só é alterado no event loop
+# (as threads do pool apenas devolvem URLs), então não precisa de lock: basta não haver
+# await entre checar e alterar o estado. slots=True deixa cada registro compacto, sem __dict__.
+@dataclass(slots=True)
+class UserState:
+    task: asyncio.Task | None = None # Tarefa que executa a transmissão
+    proc: "FFmpegProcess | None" = None # Processo FFmpeg iniciado pela tarefa
+    status: str = "Parado"
+    current_vod: str = "Nenhum"
+    # Fila de VODs que ainda não começaram a ser transmitidos: (url do VOD, prefixo da playlist)
+    vod_queue: deque[tuple[str, str]] = field(default_factory=deque)
+
+    def is_streaming(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    def set_status(self, status: str, current_vod: str):
+        self.status = status
+        self.current_vod = current_vod
+
+    def status_dict(self) -> dict:
+        return {"status": self.status, "current_vod": self.current_vod}
+
+# Chave: user_id, Valor: UserState
+users: dict[str, UserState] = {}
+
+def get_user_state(user_id: str) -> UserState:
+    state = users.get(user_id)
+    if state is None:
+        state = users[user_id] = UserState()
+    return state
+
+# Cache em memória do "está ao vivo?" da Twitch, para que o polling do dashboard
+# não gere uma chamada à Helix a cada requisição.
+# Chave: user_id, Valor: (instante em que expira, dados da stream ou None)
+STREAM_STATUS_CACHE_TTL = 15 # segundos
+_live_stream_cache: dict[str, tuple[float, dict | None]] = {}
+# Um lock por usuário: requisições simultâneas aguardam uma única chamada à Twitch
+_live_stream_locks: defaultdict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+# Cache da lista de VODs: o arquivo de um canal muda na escala de horas, então
+# recarregar o dashboard não precisa buscar /helix/videos de novo.
+# Chave: user_id, Valor: (time.monotonic() da busca, lista de VODs já formatada)
+_VODS_TTL = 60 # segundos
+# Limite de páginas de 100 VODs buscadas na Helix por listagem
+VODS_MAX_PAGES = 5
+_vods_cache: dict[str, tuple[float, list]] = {}
+_vods_locks: defaultdict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+# Tokens OAuth mais recentes de cada usuário, para que uma renovação feita por uma
+# requisição seja vista pelas demais que falharam com o token antigo.
+# Chave: user_id, Valor: dict com access_token e refresh_token
+_user_tokens: dict[str, dict] = {}
+# Um lock por usuário: N requisições com token expirado disparam um único refresh
+_refresh_locks: defaultdict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+# Intervalo mínimo entre dois refreshes do mesmo usuário. Se um token recém-renovado
+# já é recusado pela Twitch, o usuário precisa refazer o login.
+TOKEN_REFRESH_COOLDOWN = 60 # segundos
+# Chave: user_id, Valor: time.monotonic() do último refresh
+_last_token_refresh: dict[str, float] = {}
+
+# App access token (client_credentials) compartilhado por todos os usuários, usado nas
+# consultas públicas da Helix que não dependem da sessão do usuário.
+_app_token: dict = {"value": None, "exp": 0.0}
+_app_token_lock = asyncio.Lock()
+# Margem de segurança (s) para renovar o app token antes de expirar
+APP_TOKEN_EXPIRY_MARGIN = 60
+# Espera (s) antes de tentar obter o app token de novo após uma falha
+APP_TOKEN_RETRY_DELAY = 30
+
+# --- AUTENTICAÇÃO (JWT em cookie httpOnly) ---
+# Substitui o SessionMiddleware: o cookie é assinado uma vez no login (e a cada refresh
+# do token da Twitch) e apenas verificado nas demais requisições, em vez de ser
+# re-serializado e re-assinado em toda resposta.
+AUTH_COOKIE_NAME = "auth_token"
+JWT_ALGORITHM = "HS256"
+AUTH_TOKEN_TTL = 14 * 24 * 60 * 60 # 14 dias, mesmo max_age padrão do SessionMiddleware
+
+# Também aceita "Authorization: Bearer <jwt>" para clientes que não usam cookies
+oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/twitch", auto_error=False)
+
+class CurrentUser(BaseModel):
+    user_id: str
+    username: str
+    access_token: str
+    refresh_token: str | None = None
 
 # --- MODELO PARA A REQUISIÇÃO DE START STREAM ---
 class StartStreamRequest(BaseModel):
@@ -60,7 +272,7 @@ class StartStreamRequest(BaseModel):
 
 # --- Configuração do CORS Middleware ---
 origins = [
-    "http://localhost:5173",
+    FRONTEND_URL,
     "http://localhost:3000",
 ]
 
@@ -72,7 +284,265 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-app.add_middleware(SessionMiddleware, secret_key=SECRET_KEY)
+# --- Rate limit por IP (protege as rotas OAuth e a cota de tokens da Twitch) ---
+AUTH_RATE_LIMIT = "10/minute"
+limiter = Limiter(key_func=get_remote_address)
+app.state.limiter = limiter
+app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+
+def is_streaming(user_id: str) -> bool:
+    state = users.get(user_id)
+    return state is not None and state.is_streaming()
+
+# --- FUNÇÕES AUXILIARES DA TWITCH ---
+
+HELIX_BASE_URL = "https://api.twitch.tv/helix"
+# A Helix aceita até 100 user_id repetidos em uma única chamada de /streams
+HELIX_MAX_IDS_PER_REQUEST = 100
+# Limita quantas chamadas à Helix ficam em voo ao mesmo tempo
+_helix_semaphore = asyncio.Semaphore(20)
+
+async def helix_get(client: httpx.AsyncClient, path: str, params: dict, headers: dict) -> dict:
+    """GET na Helix. Valores em lista viram parâmetros repetidos (user_id=a&user_id=b)."""
+    async with _helix_semaphore:
+        response = await client.get(f"{HELIX_BASE_URL}/{path}", params=params, headers=headers)
+    response.raise_for_status()
+    return orjson.loads(response.content)
+
+async def fetch_live_streams(client: httpx.AsyncClient, user_ids: list[str], headers: dict) -> dict[str, dict]:
+    """Busca as lives de vários usuários em lotes de até 100 IDs, disparados em paralelo. Chave: user_id."""
+    batches = [
+        user_ids[i:i + HELIX_MAX_IDS_PER_REQUEST]
+        for i in range(0, len(user_ids), HELIX_MAX_IDS_PER_REQUEST)
+    ]
+    pages = await asyncio.gather(*(
+        helix_get(client, "streams", {"user_id": batch, "first": HELIX_MAX_IDS_PER_REQUEST}, headers)
+        for batch in batches
+    ))
+    return {stream["user_id"]: stream for page in pages for stream in page.get('data', ())}
+
+async def fetch_live_stream(client: httpx.AsyncClient, user_id: str, headers: dict) -> dict | None:
+    """Retorna os dados da live atual do usuário na Twitch (ou None se offline), com cache de curta duração."""
+    cached = _live_stream_cache.get(user_id)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    async with _live_stream_locks[user_id]:
+        # Outra requisição pode ter preenchido o cache enquanto esperávamos o lock
+        cached = _live_stream_cache.get(user_id)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+
+        live_streams = await fetch_live_streams(client, [user_id], headers)
+        live_stream = live_streams.get(user_id)
+
+        _live_stream_cache[user_id] = (time.monotonic() + STREAM_STATUS_CACHE_TTL, live_stream)
+        return live_stream
+
+async def request_twitch_token(client: httpx.AsyncClient, **params) -> dict:
+    """POST no endpoint OAuth da Twitch com as credenciais do app. Levanta HTTPStatusError em caso de erro."""
+    payload = {"client_id": CLIENT_ID, "client_secret": CLIENT_SECRET, **params}
+    response = await client.post(TWITCH_TOKEN_URL, data=payload)
+    response.raise_for_status()
+    return orjson.loads(response.content)
+
+def helix_headers(access_token: str) -> dict:
+    # Client-ID já faz parte dos cabeçalhos padrão do cliente compartilhado
+    return {"Authorization": "Bearer " + access_token}
+
+async def refresh_user_token(client: httpx.AsyncClient, user_id: str, stale_access_token: str, refresh_token: str | None) -> dict:
+    """Renova o access token do usuário, garantindo uma única renovação simultânea por usuário."""
+    async with _refresh_locks[user_id]:
+        # Se outra requisição já renovou o token enquanto esperávamos o lock, apenas reaproveita
+        latest = _user_tokens.get(user_id)
+        if latest:
+            if latest["access_token"] != stale_access_token:
+                return latest
+            refresh_token = latest["refresh_token"]
+
+        last_refresh = _last_token_refresh.get(user_id)
+        if last_refresh is not None and time.monotonic() - last_refresh < TOKEN_REFRESH_COOLDOWN:
+            logger.warning("[%s] Token renovado há menos de %ss já foi recusado. Novo refresh bloqueado.", user_id, TOKEN_REFRESH_COOLDOWN)
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token de acesso Twitch inválido ou expirado. Faça login novamente.")
+
+        if not refresh_token or not CLIENT_SECRET:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token de acesso Twitch expirado. Faça login novamente.")
+
+        try:
+            token_data = await request_twitch_token(client, grant_type="refresh_token", refresh_token=refresh_token)
+        except httpx.HTTPStatusError as e:
+            logger.warning("[%s] Falha ao renovar token da Twitch: %s - %s", user_id, e.response.status_code, e.response.text)
+            # A Twitch recusou o refresh token: não adianta tentar de novo durante o cooldown
+            _last_token_refresh[user_id] = time.monotonic()
+            _user_tokens.pop(user_id, None)
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token de acesso Twitch inválido ou expirado. Faça login novamente.")
+        except httpx.HTTPError as e:
+            # Falha de rede: não inicia o cooldown, a próxima requisição tenta renovar de novo
+            logger.warning("[%s] Erro de rede ao renovar token da Twitch: %s", user_id, e)
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Não foi possível contatar a Twitch para renovar o token. Tente novamente.")
+
+        _last_token_refresh[user_id] = time.monotonic()
+        tokens = {
+            "access_token": token_data["access_token"],
+            "refresh_token": token_data.get("refresh_token", refresh_token),
+        }
+        _user_tokens[user_id] = tokens
+        logger.info("[%s] Token de acesso da Twitch renovado.", user_id)
+        return tokens
+
+async def call_with_token_refresh(user: CurrentUser, client: httpx.AsyncClient, response: Response, make_call):
+    """Executa make_call(headers) com o token do usuário; em caso de 401 renova o token e tenta mais uma vez."""
+    # Captura o token antes do await: chamadas em paralelo (gather) compartilham o mesmo user,
+    # e outra delas pode renová-lo enquanto esta espera a resposta
+    access_token, refresh_token = user.access_token, user.refresh_token
+    try:
+        return await make_call(helix_headers(access_token))
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code != status.HTTP_401_UNAUTHORIZED:
+            raise
+
+    tokens = await refresh_user_token(client, user.user_id, access_token, refresh_token)
+    # Só atualiza o cookie uma vez, mesmo que várias chamadas tenham recebido o 401
+    if tokens["access_token"] != user.access_token:
+        user.access_token = tokens["access_token"]
+        user.refresh_token = tokens["refresh_token"]
+        set_auth_cookie(response, user)
+    return await make_call(helix_headers(tokens["access_token"]))
+
+async def get_app_token(client: httpx.AsyncClient) -> str | None:
+    """Retorna o app access token em cache, renovando-o (uma única vez por vez) quando perto de expirar."""
+    if not CLIENT_ID or not CLIENT_SECRET:
+        return None
+    if time.monotonic() < _app_token["exp"] - APP_TOKEN_EXPIRY_MARGIN:
+        return _app_token["value"]
+
+    async with _app_token_lock:
+        if time.monotonic() < _app_token["exp"] - APP_TOKEN_EXPIRY_MARGIN:
+            return _app_token["value"]
+
+        try:
+            token_data = await request_twitch_token(client, grant_type="client_credentials")
+        except httpx.HTTPError as e:
+            # Guarda a falha para não repetir o POST (nem o log) a cada polling enquanto a Twitch falha
+            logger.warning("Erro ao obter app access token da Twitch, nova tentativa em %ss: %s", APP_TOKEN_RETRY_DELAY, e)
+            _app_token["value"] = None
+            _app_token["exp"] = time.monotonic() + APP_TOKEN_RETRY_DELAY + APP_TOKEN_EXPIRY_MARGIN
+            return None
+
+        _app_token["value"] = token_data["access_token"]
+        _app_token["exp"] = time.monotonic() + token_data["expires_in"]
+        return _app_token["value"]
+
+async def fetch_archive_pages(client: httpx.AsyncClient, user_id: str, headers: dict) -> list[list[dict]]:
+    """Busca os VODs do usuário em páginas de 100, seguindo o cursor da Helix até VODS_MAX_PAGES páginas."""
+    params = {"user_id": user_id, "type": "archive", "first": HELIX_MAX_IDS_PER_REQUEST}
+    pages = []
+    # Cada cursor só vem na resposta da página anterior, então as páginas são buscadas em sequência
+    while len(pages) < VODS_MAX_PAGES:
+        videos_json = await helix_get(client, "videos", params, headers)
+        pages.append(videos_json.get('data', ()))
+        cursor = videos_json.get('pagination', {}).get('cursor')
+        if not cursor:
+            break
+        params = {**params, "after": cursor}
+    return pages
+
+async def fetch_user_vods(client: httpx.AsyncClient, user: CurrentUser, response: Response) -> list[dict]:
+    """Retorna os VODs (arquivos de transmissões) do usuário, com cache por usuário de _VODS_TTL segundos."""
+    user_id = user.user_id
+    cached = _vods_cache.get(user_id)
+    if cached and time.monotonic() - cached[0] < _VODS_TTL:
+        return cached[1]
+
+    async with _vods_locks[user_id]:
+        cached = _vods_cache.get(user_id)
+        if cached and time.monotonic() - cached[0] < _VODS_TTL:
+            return cached[1]
+
+        pages = await call_with_token_refresh(
+            user, client, response,
+            lambda headers: fetch_archive_pages(client, user_id, headers),
+        )
+        vods_data = [
+            {
+                "id": video["id"],
+                "title": video["title"],
+                "url": video["url"],
+                "thumbnail_url": video.get("thumbnail_url", "").replace(THUMBNAIL_SIZE_PLACEHOLDER, THUMBNAIL_SIZE),
+                "duration": video["duration"],
+            }
+            for video in itertools.chain.from_iterable(pages)
+        ]
+        _vods_cache[user_id] = (time.monotonic(), vods_data)
+        return vods_data
+
+async def fetch_user_live_stream(client: httpx.AsyncClient, user: CurrentUser, response: Response) -> dict | None:
+    """Consulta se o usuário está ao vivo usando o app token; recorre ao token do usuário se ele não estiver disponível."""
+    app_token = await get_app_token(client)
+    if app_token:
+        try:
+            return await fetch_live_stream(client, user.user_id, helix_headers(app_token))
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code != status.HTTP_401_UNAUTHORIZED:
+                raise
+            # App token revogado: força a renovação na próxima chamada e usa o token do usuário agora
+            _app_token["exp"] = 0.0
+
+    return await call_with_token_refresh(
+        user, client, response,
+        lambda headers: fetch_live_stream(client, user.user_id, headers),
+    )
+
+def set_auth_cookie(response: Response, user: CurrentUser):
+    claims = {
+        "sub": user.user_id,
+        "name": user.username,
+        "tw_at": user.access_token,
+        "tw_rt": user.refresh_token,
+        "exp": int(time.time()) + AUTH_TOKEN_TTL,
+    }
+    token = jwt.encode(claims, SECRET_KEY, algorithm=JWT_ALGORITHM)
+    response.set_cookie(AUTH_COOKIE_NAME, token, max_age=AUTH_TOKEN_TTL, httponly=True, samesite="lax")
+
+async def get_optional_user(request: Request, bearer_token: str | None = Depends(oauth2_scheme)) -> CurrentUser | None:
+    token = request.cookies.get(AUTH_COOKIE_NAME) or bearer_token
+    if not token:
+        return None
+    try:
+        claims = jwt.decode(token, SECRET_KEY, algorithms=[JWT_ALGORITHM])
+    except JWTError:
+        return None
+    return CurrentUser(
+        user_id=claims["sub"],
+        username=claims["name"],
+        access_token=claims["tw_at"],
+        refresh_token=claims.get("tw_rt"),
+    )
+
+async def get_current_user(user: CurrentUser | None = Depends(get_optional_user)) -> CurrentUser:
+    if user is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Não autenticado. Faça login via Twitch.")
+    return user
+
+def etag_response(request: Request, response: Response, payload: dict) -> Response:
+    """Serializa o payload com ETag e Cache-Control; responde 304 sem corpo se o cliente já tem essa versão."""
+    body = orjson.dumps(payload)
+    etag = f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+    # no-cache: o navegador sempre revalida (o dashboard consulta o status a cada 5 s e os dados
+    # dependem de quem está logado); o ganho fica no 304 sem corpo quando nada mudou
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache", "Vary": "Cookie, Authorization"}
+
+    if request.headers.get("if-none-match") == etag:
+        result = Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    else:
+        result = Response(content=body, media_type="application/json", headers=headers)
+    # Preserva cabeçalhos definidos durante a requisição (ex.: cookie renovado no refresh)
+    result.headers.raw.extend(response.headers.raw)
+    return result
+
+def frontend_redirect(base_url: str, **params) -> RedirectResponse:
+    # urlencode garante que valores como error_description e username cheguem intactos ao frontend
+    return RedirectResponse(url=base_url + urlencode(params), status_code=status.HTTP_302_FOUND)
 
 # --- ROTAS DA API ---
 
@@ -81,341 +551,417 @@ async def read_root():
     return {"message": "Bem-vindo ao Backend Twitch VODs!"}
 
 @app.get("/api/auth/twitch", response_class=RedirectResponse)
-async def twitch_auth():
-    if not CLIENT_ID:
+@limiter.limit(AUTH_RATE_LIMIT)
+async def twitch_auth(request: Request):
+    if TWITCH_AUTH_URL is None:
         raise HTTPException(status_code=500, detail="TWITCH_CLIENT_ID não configurado no .env")
 
-    scopes = "user:read:email user:read:broadcast"
-    twitch_auth_url = (
-        f"https://id.twitch.tv/oauth2/authorize?client_id={CLIENT_ID}"
-        f"&redirect_uri={REDIRECT_URI}"
-        f"&response_type=code"
-        f"&scope={scopes}"
-    )
-    return RedirectResponse(url=twitch_auth_url)
+    return RedirectResponse(url=TWITCH_AUTH_URL)
 
 @app.get("/api/auth/callback")
-async def twitch_callback(request: Request, code: str = None, error: str = None, error_description: str = None):
+@limiter.limit(AUTH_RATE_LIMIT)
+async def twitch_callback(request: Request, code: str = None, error: str = None, error_description: str = None,
+                          client: httpx.AsyncClient = Depends(get_http_client)):
     if error:
-        print(f"Erro no callback Twitch: {error} - {error_description}")
-        frontend_redirect_url = f"http://localhost:5173/login?error={error}&error_description={error_description}"
-        return RedirectResponse(url=frontend_redirect_url, status_code=status.HTTP_302_FOUND)
+        logger.warning("Erro no callback Twitch: %s - %s", error, error_description)
+        return frontend_redirect(FRONTEND_LOGIN_URL, error=error, error_description=error_description)
 
     if not code:
-        print("Código de autorização não recebido no callback.")
-        frontend_redirect_url = "http://localhost:5173/login?error=no_code_received"
-        return RedirectResponse(url=frontend_redirect_url, status_code=status.HTTP_302_FOUND)
+        logger.warning("Código de autorização não recebido no callback.")
+        return frontend_redirect(FRONTEND_LOGIN_URL, error="no_code_received")
 
     if not CLIENT_ID or not CLIENT_SECRET or not REDIRECT_URI:
         raise HTTPException(status_code=500, detail="Variáveis de ambiente Twitch não configuradas.")
 
-    token_url = "https://id.twitch.tv/oauth2/token"
-    payload = {
-        "client_id": CLIENT_ID,
-        "client_secret": CLIENT_SECRET,
-        "code": code,
-        "grant_type": "authorization_code",
-        "redirect_uri": REDIRECT_URI,
-    }
-
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(token_url, data=payload)
-            response.raise_for_status()
-            token_data = response.json()
-            access_token = token_data.get("access_token")
-            refresh_token = token_data.get("refresh_token")
-
-            if not access_token:
-                print("Token de acesso não recebido.")
-                frontend_redirect_url = "http://localhost:5173/login?error=no_access_token"
-                return RedirectResponse(url=frontend_redirect_url, status_code=status.HTTP_302_FOUND)
-
-            user_info_url = "https://api.twitch.tv/helix/users"
-            headers = {
-                "Client-ID": CLIENT_ID,
-                "Authorization": f"Bearer {access_token}",
-            }
-            user_info_response = await client.get(user_info_url, headers=headers)
-            user_info_response.raise_for_status()
-            user_info_data = user_info_response.json()
-            user_data = user_info_data.get("data")
-
-            if not user_data:
-                print("Dados do usuário não encontrados após autenticação.")
-                frontend_redirect_url = "http://localhost:5173/login?error=user_info_failed"
-                return RedirectResponse(url=frontend_redirect_url, status_code=status.HTTP_302_FOUND)
-
-            username = user_data[0].get("display_name")
-            user_id = user_data[0].get("id")
-
-            request.session['user_access_token'] = access_token
-            request.session['refresh_token'] = refresh_token
-            request.session['username'] = username
-            request.session['user_id'] = user_id
-
-            # Inicializa o status para o novo usuário
-            user_stream_status[user_id] = {"status": "Parado", "current_vod": "Nenhum"}
-
-            print(f"Usuário {username} autenticado com sucesso. Redirecionando para o dashboard.")
-            frontend_redirect_url = f"http://localhost:5173/dashboard?success=true&username={username}"
-            return RedirectResponse(url=frontend_redirect_url, status_code=status.HTTP_302_FOUND)
-
-        except httpx.HTTPStatusError as e:
-            print(f"Erro HTTP na API da Twitch durante o callback: {e.response.status_code} - {e.response.text}")
-            frontend_redirect_url = f"http://localhost:5173/login?error=twitch_api_error&details={e.response.status_code}"
-            return RedirectResponse(url=frontend_redirect_url, status_code=status.HTTP_302_FOUND)
-        except Exception as e:
-            print(f"Erro inesperado no callback OAuth: {e}")
-            frontend_redirect_url = f"http://localhost:5173/login?error=internal_server_error"
-            return RedirectResponse(url=frontend_redirect_url, status_code=status.HTTP_302_FOUND)
+    try:
+        token_data = await request_twitch_token(
+            client, grant_type="authorization_code", code=code, redirect_uri=REDIRECT_URI,
+        )
+        access_token = token_data.get("access_token")
+        refresh_token = token_data.get("refresh_token")
+
+        if not access_token:
+            logger.warning("Token de acesso não recebido.")
+            return frontend_redirect(FRONTEND_LOGIN_URL, error="no_access_token")
+
+        # Sem parâmetros, /helix/users retorna o dono do token
+        user_info_data = await helix_get(client, "users", {}, helix_headers(access_token))
+        user_data = user_info_data.get("data")
+
+        if not user_data:
+            logger.warning("Dados do usuário não encontrados após autenticação.")
+            return frontend_redirect(FRONTEND_LOGIN_URL, error="user_info_failed")
+
+        username = user_data[0].get("display_name")
+        user_id = user_data[0].get("id")
+
+        _user_tokens[user_id] = {"access_token": access_token, "refresh_token": refresh_token}
+
+        # Inicializa o status para o novo usuário
+        get_user_state(user_id).set_status("Parado", "Nenhum")
+
+        logger.info("Usuário %s autenticado com sucesso. Redirecionando para o dashboard.", username)
+        redirect = frontend_redirect(FRONTEND_DASHBOARD_URL, success="true", username=username)
+        set_auth_cookie(redirect, CurrentUser(
+            user_id=user_id,
+            username=username,
+            access_token=access_token,
+            refresh_token=refresh_token,
+        ))
+        return redirect
+
+    except httpx.HTTPStatusError as e:
+        logger.exception("Erro HTTP na API da Twitch durante o callback: %s - %s", e.response.status_code, e.response.text)
+        return frontend_redirect(FRONTEND_LOGIN_URL, error="twitch_api_error", details=e.response.status_code)
+    except Exception as e:
+        logger.exception("Erro inesperado no callback OAuth: %s", e)
+        return frontend_redirect(FRONTEND_LOGIN_URL, error="internal_server_error")
 
 @app.post("/api/logout")
-async def logout(request: Request):
-    user_id = request.session.get('user_id')
-    if user_id and user_id in active_streams:
-        process_to_kill = active_streams.pop(user_id)
-        if process_to_kill.poll() is None:
-            print(f"Encerrando stream ativa para {user_id} antes do logout.")
-            process_to_kill.terminate()
-        if user_id in user_stream_status:
-            user_stream_status[user_id] = {"status": "Parado", "current_vod": "Nenhum"}
-
-    request.session.clear()
+async def logout(response: Response, user: CurrentUser | None = Depends(get_optional_user)):
+    user_id = user.user_id if user else None
+    if user_id and is_streaming(user_id):
+        state = users[user_id]
+        task, proc = state.task, state.proc
+        state.task = state.proc = None
+        logger.info("Encerrando stream ativa para %s antes do logout.", user_id)
+        await terminate_stream(user_id, task, proc)
+        state.set_status("Parado", "Nenhum")
+    if user_id:
+        _user_tokens.pop(user_id, None)
+        _last_token_refresh.pop(user_id, None)
+        _vods_cache.pop(user_id, None)
+
+    response.delete_cookie(AUTH_COOKIE_NAME, httponly=True, samesite="lax")
     return {"message": "Sessão encerrada com sucesso."}
 
 @app.get("/api/vods")
-async def get_vods_data(request: Request):
-    user_access_token = request.session.get('user_access_token')
-    username = request.session.get('username')
-    user_id = request.session.get('user_id')
+async def get_vods_data(request: Request, response: Response, user: CurrentUser = Depends(get_current_user),
+                        client: httpx.AsyncClient = Depends(get_http_client)):
+    user_id = user.user_id
 
-    if not user_access_token or not username or not user_id:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Não autenticado. Faça login via Twitch.")
-
-    headers = {
-        "Client-ID": CLIENT_ID,
-        "Authorization": f"Bearer {user_access_token}",
-    }
-
-    vods_data = []
     # Pega o status atual do usuário. Se não existir, inicializa como parado.
-    stream_status = user_stream_status.get(user_id, {"status": "Parado", "current_vod": "Nenhum"})
-
-    async with httpx.AsyncClient() as client:
-        try:
-            videos_url = f"https://api.twitch.tv/helix/videos?user_id={user_id}&type=archive"
-            videos_response = await client.get(videos_url, headers=headers)
-            videos_response.raise_for_status()
-            videos_json = videos_response.json()
-
-            for video in videos_json.get('data', []):
-                thumbnail = video.get("thumbnail_url", "").replace("%{width}x%{height}", "320x180")
-                vods_data.append({
-                    "id": video.get("id"),
-                    "title": video.get("title"),
-                    "url": video.get("url"),
-                    "thumbnail_url": thumbnail,
-                    "duration": video.get("duration"),
-                })
-
-            # Verifica o status da transmissão atual na Twitch API (para garantir que não estamos transmitindo de outro lugar)
-            stream_url = f"https://api.twitch.tv/helix/streams?user_id={user_id}"
-            stream_response = await client.get(stream_url, headers=headers)
-            stream_response.raise_for_status()
-            stream_json = stream_response.json()
-
-            if stream_json.get('data'):
-                current_stream = stream_json['data'][0]
-                stream_status["status"] = "Ao Vivo" # Status da Twitch API
-                stream_status["current_vod"] = current_stream.get("title", "Stream ao vivo")
-            # Se não estiver ao vivo na Twitch, mas estiver transmitindo via backend, manter o status do backend
-            elif user_id in active_streams and active_streams[user_id].poll() is None:
-                stream_status["status"] = "Transmitindo (via Backend)"
-                # current_vod é atualizado na função stream_vods_thread
-            else:
-                stream_status["status"] = "Parado"
-                stream_status["current_vod"] = "Nenhum"
+    state = get_user_state(user_id)
 
+    try:
+        if state.is_streaming():
+            # Transmitindo via backend: o status já é conhecido, não precisa consultar a Twitch
+            vods_data = await fetch_user_vods(client, user, response)
+            state.status = "Transmitindo (via Backend)"
+            # current_vod é atualizado pela tarefa stream_vods_task
+        else:
+            # As duas chamadas são independentes: dispara ambas ao mesmo tempo.
+            # O status da live verifica se não estamos transmitindo de outro lugar.
+            vods_data, current_stream = await asyncio.gather(
+                fetch_user_vods(client, user, response),
+                fetch_user_live_stream(client, user, response),
+            )
 
-        except httpx.HTTPStatusError as e:
-            print(f"Erro ao buscar dados da Twitch API (VODs/Stream Status): {e.response.status_code} - {e.response.text}")
-            if e.response.status_code in [401, 403]:
-                raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token de acesso Twitch inválido ou expirado. Faça login novamente.")
+            if current_stream:
+                state.set_status("Ao Vivo", current_stream.get("title", "Stream ao vivo")) # Status da Twitch API
             else:
-                raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Erro ao comunicar com a API da Twitch: {e.response.text}")
-        except Exception as e:
-            print(f"Erro inesperado ao buscar VODs e status: {e}")
-            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Erro interno ao buscar dados do Twitch.")
+                state.set_status("Parado", "Nenhum")
+
 
-    # Atualiza o status global para o usuário
-    user_stream_status[user_id] = stream_status
+    except HTTPException:
+        raise
+    except httpx.HTTPStatusError as e:
+        logger.exception("Erro ao buscar dados da Twitch API (VODs/Stream Status): %s - %s", e.response.status_code, e.response.text)
+        if e.response.status_code in [401, 403]:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token de acesso Twitch inválido ou expirado. Faça login novamente.")
+        else:
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Erro ao comunicar com a API da Twitch: {e.response.text}")
+    except Exception as e:
+        logger.exception("Erro inesperado ao buscar VODs e status: %s", e)
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Erro interno ao buscar dados do Twitch.")
 
-    return JSONResponse(content={
-        "username": username,
+    return etag_response(request, response, {
+        "username": user.username,
         "vods": vods_data,
-        "status": stream_status
+        "status": state.status_dict()
     })
 
 @app.get("/api/stream_status")
-async def get_stream_status(request: Request):
-    user_id = request.session.get('user_id')
-
-    if not user_id:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Não autenticado. Faça login via Twitch para verificar o status da transmissão.")
+async def get_stream_status(request: Request, response: Response, user: CurrentUser = Depends(get_current_user),
+                            client: httpx.AsyncClient = Depends(get_http_client)):
+    user_id = user.user_id
 
     # Retorna o status armazenado para o usuário
-    current_status = user_stream_status.get(user_id, {"status": "Parado", "current_vod": "Nenhum"})
+    state = get_user_state(user_id)
 
     # Verifica se o processo FFmpeg ainda está ativo
-    if user_id in active_streams and active_streams[user_id].poll() is None:
-        current_status["status"] = "Transmitindo (via Backend)"
+    if state.is_streaming():
+        state.status = "Transmitindo (via Backend)"
     else:
         # Se o processo não está ativo, mas o status ainda diz transmitindo, corrige
-        if current_status["status"] == "Transmitindo (via Backend)":
-             current_status["status"] = "Parado"
-             current_status["current_vod"] = "Nenhum"
+        if state.status == "Transmitindo (via Backend)":
+             state.set_status("Parado", "Nenhum")
         # Além disso, faz uma checagem rápida na Twitch API para ver se está ao vivo por fora
-        headers = {
-            "Client-ID": CLIENT_ID,
-            "Authorization": f"Bearer {request.session.get('user_access_token')}",
-        }
-        async with httpx.AsyncClient() as client:
-            try:
-                stream_url = f"https://api.twitch.tv/helix/streams?user_id={user_id}"
-                stream_response = await client.get(stream_url, headers=headers)
-                stream_response.raise_for_status()
-                stream_json = stream_response.json()
-                if stream_json.get('data'):
-                    current_stream = stream_json['data'][0]
-                    current_status["status"] = "Ao Vivo"
-                    current_status["current_vod"] = current_stream.get("title", "Stream ao vivo")
-            except Exception as e:
-                print(f"Erro ao verificar status da Twitch API no polling: {e}")
-                pass # Apenas loga e mantém o status atual
-
-    user_stream_status[user_id] = current_status # Atualiza o status global
-
-    return JSONResponse(content=current_status)
-
-
-# --- FUNÇÃO QUE EXECUTA A TRANSMISSÃO EM UMA THREAD SEPARADA (ADAPTADA E CORRIGIDA) ---
-def stream_vods_thread(user_id: str, vod_urls: list[str], quality: str, stream_key: str):
-    global active_streams
-    global user_stream_status
+        try:
+            current_stream = await fetch_user_live_stream(client, user, response)
+            if current_stream:
+                state.set_status("Ao Vivo", current_stream.get("title", "Stream ao vivo"))
+        except Exception as e:
+            logger.exception("Erro ao verificar status da Twitch API no polling: %s", e)
+            pass # Apenas loga e mantém o status atual
+
+    return etag_response(request, response, state.status_dict())
+
+
+# --- TAREFA ASSÍNCRONA QUE EXECUTA A TRANSMISSÃO ---
+
+# O HLS do FFmpeg registra cada segmento que abre; usado para saber qual VOD está no ar
+FFMPEG_OPENING_RE = re.compile(r"Opening '([^']+)' for reading")
+
+def playlist_prefix(m3u8_url: str) -> str:
+    # Os segmentos de um VOD ficam no mesmo diretório da sua playlist
+    return m3u8_url.split('?', 1)[0].rsplit('/', 1)[0] + '/'
+
+def build_concat_script(m3u8_urls: list[str]) -> str:
+    # Lista para o demuxer concat do FFmpeg; aspas simples são escapadas no formato do ffconcat
+    lines = ["ffconcat version 1.0"]
+    lines.extend("file '" + url.replace("'", "'\\''") + "'" for url in m3u8_urls)
+    return "\n".join(lines) + "\n"
+
+# Sessão única do Streamlink: reaproveita a sessão HTTP (e as conexões TLS) entre resoluções
+streamlink_session = streamlink.Streamlink()
+# Pool compartilhado para as resoluções (bloqueantes) do Streamlink
+MAX_VOD_RESOLVE_WORKERS = 8
+_vod_resolve_executor = ThreadPoolExecutor(max_workers=MAX_VOD_RESOLVE_WORKERS, thread_name_prefix="vod-resolve")
+
+# Cache das URLs M3U8 já resolvidas: parar e reiniciar com os mesmos VODs não refaz as
+# consultas à Twitch. As URLs são assinadas e valem por mais tempo que o TTL.
+# Chave: (url do VOD, qualidade), Valor: (time.monotonic() da resolução, url M3U8)
+_M3U8_TTL = 600 # segundos
+_m3u8_cache: dict[tuple[str, str], tuple[float, str]] = {}
+
+def resolve_vod_m3u8(user_id: str, url: str, quality: str) -> str | None:
+    """Retorna a URL M3U8 do VOD na qualidade pedida (ou 'best' como fallback), ou None se não houver."""
+    key = (url, quality)
+    cached = _m3u8_cache.get(key)
+    if cached:
+        if time.monotonic() - cached[0] < _M3U8_TTL:
+            return cached[1]
+        _m3u8_cache.pop(key, None)
+
+    try:
+        streams = streamlink_session.streams(url)
+        m3u8_url = None # Inicializa como None
+        if quality in streams:
+            m3u8_url = streams[quality].url
+        elif 'best' in streams: # Verifica se 'best' existe como fallback
+            m3u8_url = streams['best'].url
+
+        if m3u8_url:
+            now = time.monotonic()
+            # Descarta as entradas vencidas para o cache não crescer a cada VOD novo.
+            # list() copia os itens de uma vez, seguro com outras threads alterando o dict
+            for old_key, (resolved_at, _) in list(_m3u8_cache.items()):
+                if now - resolved_at >= _M3U8_TTL:
+                    _m3u8_cache.pop(old_key, None)
+            _m3u8_cache[key] = (now, m3u8_url)
+        else:
+            logger.warning("[%s] Aviso: Não foi possível obter URL M3U8 para VOD: %s com qualidade '%s'.", user_id, url, quality)
+        return m3u8_url
+    except streamlink.exceptions.NoStreamsError:
+        logger.warning("[%s] Aviso: Nenhuma stream encontrada para VOD: %s", user_id, url)
+    except Exception as e:
+        logger.exception("[%s] Erro ao obter URL M3U8 para %s: %s", user_id, url, e)
+    return None
+
+class ThreadedStdin:
+    def __init__(self, pipe):
+        self._pipe = pipe
+
+    def write(self, data: bytes):
+        self._pipe.write(data)
 
+    async def drain(self):
+        await asyncio.to_thread(self._pipe.flush)
+
+    def close(self):
+        self._pipe.close()
+
+class PopenProcess:
+    """subprocess.Popen com a interface de asyncio.subprocess.Process usada aqui; a espera e a leitura rodam em threads."""
+
+    def __init__(self, popen: subprocess.Popen):
+        self._popen = popen
+        self.pid = popen.pid
+        self.stdin = ThreadedStdin(popen.stdin)
+        self.stderr = self._stderr_lines()
+
+    @property
+    def returncode(self) -> int | None:
+        return self._popen.poll()
+
+    async def _stderr_lines(self):
+        while line := await asyncio.to_thread(self._popen.stderr.readline):
+            yield line
+
+    async def wait(self) -> int:
+        return await asyncio.to_thread(self._popen.wait)
+
+    def terminate(self):
+        self._popen.terminate()
+
+    def kill(self):
+        self._popen.kill()
+
+FFmpegProcess = asyncio.subprocess.Process | PopenProcess
+
+async def spawn_ffmpeg(*args: str) -> FFmpegProcess:
+    try:
+        return await asyncio.create_subprocess_exec(
+            *args,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+        )
+    except NotImplementedError:
+        # Loop sem suporte a subprocessos (SelectorEventLoop no Windows, usado pelo uvicorn
+        # com --reload/--workers): usa Popen e espera o processo em threads
+        return PopenProcess(subprocess.Popen(
+            args, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        ))
+
+async def log_ffmpeg_stderr(proc: "FFmpegProcess", user_id: str, state: UserState, prefixes: set[str]):
+    """Registra a saída do FFmpeg e atualiza o current_vod quando ele começa a ler um novo VOD."""
+    current_prefix = None
+    async for line in proc.stderr:
+        line = line.decode(errors='ignore').strip()
+        if FFMPEG_LOG:
+            logger.info("[%s][FFmpeg STDERR]: %s", user_id, line)
+
+        match = FFMPEG_OPENING_RE.search(line)
+        if not match:
+            continue
+        opened_url = match.group(1)
+        if current_prefix and opened_url.startswith(current_prefix):
+            continue
+        if not any(opened_url.startswith(prefix) for prefix in prefixes):
+            continue
+        # Segmento de um VOD novo: avança a fila até ele
+        while state.vod_queue:
+            vod_url, prefix = state.vod_queue.popleft()
+            if opened_url.startswith(prefix):
+                logger.info("[%s] Transmitindo VOD: %s", user_id, vod_url)
+                state.current_vod = vod_url
+                current_prefix = prefix
+                break
+
+async def stream_vods_task(state: UserState, user_id: str, vod_urls: list[str], quality: str, stream_key: str):
     rtmp_url = f"rtmp://live.twitch.tv/app/{stream_key}"
-    
-    # Limpa a fila de VODs para este usuário e adiciona os novos
-    if user_id not in user_vod_queues:
-        user_vod_queues[user_id] = queue.Queue()
-    else:
-        while not user_vod_queues[user_id].empty():
-            user_vod_queues[user_id].get()
 
-    # Adiciona os VODs selecionados à fila
-    for url in vod_urls:
-        try:
-            streams = streamlink.streams(url)
-            m3u8_url = None # Inicializa como None
-            if quality in streams:
-                m3u8_url = streams[quality].url
-            elif 'best' in streams: # Verifica se 'best' existe como fallback
-                m3u8_url = streams['best'].url
-
-            if m3u8_url: # Agora verifica a variável m3u8_url corretamente
-                user_vod_queues[user_id].put(m3u8_url)
-            else:
-                print(f"[{user_id}] Aviso: Não foi possível obter URL M3U8 para VOD: {url} com qualidade '{quality}'.")
-        except streamlink.exceptions.NoStreamsError:
-            print(f"[{user_id}] Aviso: Nenhuma stream encontrada para VOD: {url}")
-        except Exception as e:
-            print(f"[{user_id}] Erro ao obter URL M3U8 para {url}: {e}")
-            traceback.print_exc() # Imprime o stack trace completo para depuração
-
-    if user_vod_queues[user_id].empty():
-        print(f"[{user_id}] Nenhuma URL de VOD válida foi adicionada à fila. Encerrando thread de stream.")
-        user_stream_status[user_id] = {"status": "Parado", "current_vod": "Nenhum"}
-        if user_id in active_streams:
-            del active_streams[user_id]
-        return
-
-    print(f"[{user_id}] Iniciando processo FFmpeg principal para RTMP: {rtmp_url}")
-    user_stream_status[user_id] = {"status": "Transmitindo (via Backend)", "current_vod": "Iniciando..."}
-    
+    task = asyncio.current_task()
     ffmpeg_process = None # Inicializa para o bloco finally
     try:
-        ffmpeg_process = subprocess.Popen(
-            [FFMPEG_PATH, "-i", "-", "-c:v", "copy", "-c:a", "aac", "-f", "flv", rtmp_url],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.PIPE,
-            bufsize=0
+        # Limpa a fila de VODs para este usuário e adiciona os novos
+        state.vod_queue.clear()
+
+        # Resolve a playlist M3U8 de todos os VODs selecionados em paralelo (cada um é uma ida
+        # e volta HTTPS à Twitch e o Streamlink é bloqueante, por isso roda no pool de threads)
+        loop = asyncio.get_running_loop()
+        m3u8_urls = await asyncio.gather(*(
+            loop.run_in_executor(_vod_resolve_executor, resolve_vod_m3u8, user_id, url, quality)
+            for url in vod_urls
+        ))
+        # (url do VOD, url M3U8), na ordem de transmissão
+        playlist = [(url, m3u8_url) for url, m3u8_url in zip(vod_urls, m3u8_urls) if m3u8_url]
+
+        if not playlist:
+            logger.warning("[%s] Nenhuma URL de VOD válida foi adicionada à fila. Encerrando transmissão.", user_id)
+            return
+
+        # A fila guarda os VODs que ainda não começaram a ser transmitidos
+        prefixes = set()
+        for vod_url, m3u8_url in playlist:
+            state.vod_queue.append((vod_url, playlist_prefix(m3u8_url)))
+            prefixes.add(playlist_prefix(m3u8_url))
+
+        logger.info("[%s] Iniciando processo FFmpeg principal para RTMP: %s", user_id, rtmp_url)
+        state.set_status("Transmitindo (via Backend)", "Iniciando...")
+
+        # Um único FFmpeg lê todos os VODs em sequência pelo demuxer concat (lista enviada pelo stdin)
+        # e publica direto no RTMP: os bytes do vídeo não passam mais pelo Python.
+        ffmpeg_process = await spawn_ffmpeg(
+            FFMPEG_PATH,
+            # A linha de progresso padrão termina em \r, nunca em \n, e estouraria o buffer de
+            # leitura por linha do stderr. Com FFMPEG_LOG o progresso sai em linhas key=value.
+            "-nostats",
+            *(("-progress", "pipe:2") if FFMPEG_LOG else ()),
+            # Fila de pacotes maior na entrada evita descartes ("Thread message queue blocking")
+            "-thread_queue_size", "4096",
+            # Lê os VODs na velocidade de reprodução: sem isso o FFmpeg empurra o arquivo inteiro
+            # para o RTMP o mais rápido possível
+            "-re",
+            "-fflags", "+nobuffer",
+            "-f", "concat", "-safe", "0",
+            "-protocol_whitelist", "pipe,file,http,https,tcp,tls,crypto",
+            "-i", "pipe:0",
+            "-c:v", "copy", "-c:a", "aac",
+            # Envia cada pacote assim que é gerado, mantendo a latência do RTMP baixa
+            "-flush_packets", "1",
+            "-f", "flv", rtmp_url,
         )
-        active_streams[user_id] = ffmpeg_process
-
-        def log_ffmpeg_stderr(proc, user_id_log):
-            for line in proc.stderr:
-                print(f"[{user_id_log}][FFmpeg STDERR]: {line.decode(errors='ignore').strip()}")
-        threading.Thread(target=log_ffmpeg_stderr, args=(ffmpeg_process, user_id), daemon=True).start()
-
-        while not user_vod_queues[user_id].empty() and ffmpeg_process.poll() is None:
-            vod_url = user_vod_queues[user_id].get()
-            print(f"[{user_id}] Transmitindo VOD: {vod_url}")
-            user_stream_status[user_id]["current_vod"] = vod_url
-            
-            decode_proc = subprocess.Popen(
-                [FFMPEG_PATH, "-i", vod_url, "-f", "mpegts", "-c:v", "copy", "-c:a", "aac", "-"],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.DEVNULL
-            )
-            
-            while True:
-                chunk = decode_proc.stdout.read(4096)
-                if not chunk:
-                    break
-                try:
-                    ffmpeg_process.stdin.write(chunk)
-                except BrokenPipeError:
-                    print(f"[{user_id}] BrokenPipeError: FFmpeg principal encerrou inesperadamente.")
-                    break
-                except ValueError:
-                    print(f"[{user_id}] ValueError: stdin do FFmpeg principal foi fechado.")
-                    break
-            decode_proc.wait()
-
-        if ffmpeg_process and ffmpeg_process.stdin:
+        if state.task is task:
+            state.proc = ffmpeg_process
+        stderr_task = asyncio.create_task(log_ffmpeg_stderr(ffmpeg_process, user_id, state, prefixes))
+
+        try:
+            ffmpeg_process.stdin.write(build_concat_script([m3u8_url for _, m3u8_url in playlist]).encode())
+            await ffmpeg_process.stdin.drain()
             ffmpeg_process.stdin.close()
-        if ffmpeg_process:
-            ffmpeg_process.wait()
-            print(f"[{user_id}] FFmpeg principal terminou com código: {ffmpeg_process.returncode}")
+        except (BrokenPipeError, ConnectionResetError):
+            logger.warning("[%s] BrokenPipeError: FFmpeg principal encerrou inesperadamente.", user_id)
+
+        await ffmpeg_process.wait()
+        await stderr_task
+        logger.info("[%s] FFmpeg principal terminou com código: %s", user_id, ffmpeg_process.returncode)
 
     except FileNotFoundError as e:
-        print(f"[{user_id}] Erro: Comando não encontrado - '{e.filename}'. Certifique-se de que FFmpeg e Streamlink estão instalados e no PATH do servidor, ou que os caminhos em .env estão corretos.")
-        user_stream_status[user_id] = {"status": "Erro", "current_vod": f"Ferramenta não encontrada: {e.filename}"}
+        logger.error("[%s] Erro: Comando não encontrado - '%s'. Certifique-se de que FFmpeg e Streamlink estão instalados e no PATH do servidor, ou que os caminhos em .env estão corretos.", user_id, e.filename)
+        state.set_status("Erro", f"Ferramenta não encontrada: {e.filename}")
     except Exception as e:
-        print(f"[{user_id}] Erro inesperado na thread de stream: {e}")
-        traceback.print_exc()
-        user_stream_status[user_id] = {"status": "Erro", "current_vod": f"Erro interno: {str(e)}"}
+        logger.exception("[%s] Erro inesperado na tarefa de stream: %s", user_id, e)
+        state.set_status("Erro", f"Erro interno: {str(e)}")
     finally:
-        if user_id in active_streams:
-            proc = active_streams.pop(user_id)
-            if proc and proc.poll() is None:
-                proc.terminate()
-                proc.wait(timeout=5)
-            print(f"[{user_id}] Processo FFmpeg limpo.")
-        
-        user_stream_status[user_id] = {"status": "Parado", "current_vod": "Nenhum"}
-        print(f"[{user_id}] Thread de transmissão encerrada. Status: Parado.")
-
-
-# --- Rota para iniciar transmissão (AGORA CHAMA A THREAD) ---
+        if ffmpeg_process and ffmpeg_process.returncode is None:
+            ffmpeg_process.terminate()
+            await ffmpeg_process.wait()
+            logger.info("[%s] Processo FFmpeg limpo.", user_id)
+
+        # Só limpa o estado se ele ainda for desta transmissão (o usuário pode ter iniciado outra)
+        if state.task is task:
+            state.task = state.proc = None
+        if state.task is None:
+            state.set_status("Parado", "Nenhum")
+        logger.info("[%s] Tarefa de transmissão encerrada. Status: Parado.", user_id)
+
+async def terminate_stream(user_id: str, task: asyncio.Task, proc: "FFmpegProcess | None"):
+    if proc is not None and proc.returncode is None:
+        logger.info("[%s] Encerrando transmissão. PID do FFmpeg: %s", user_id, proc.pid)
+        proc.terminate()
+        try:
+            await asyncio.wait_for(proc.wait(), timeout=5)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+    elif not task.done():
+        # Ainda resolvendo os VODs: o FFmpeg nem chegou a ser iniciado
+        task.cancel()
+
+async def stop_all_streams():
+    await asyncio.gather(*(
+        terminate_stream(user_id, state.task, state.proc)
+        for user_id, state in users.items() if state.is_streaming()
+    ), return_exceptions=True)
+
+
+# --- Rota para iniciar transmissão (cria uma tarefa asyncio) ---
 @app.post("/api/stream/start")
-async def start_stream_route(request: Request, stream_data: StartStreamRequest):
-    user_id = request.session.get('user_id')
-
-    if not user_id:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Não autenticado. Faça login.")
+async def start_stream_route(stream_data: StartStreamRequest, user: CurrentUser = Depends(get_current_user)):
+    user_id = user.user_id
 
     if not stream_data.stream_key:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="A Stream Key é necessária para iniciar a transmissão.")
@@ -423,45 +969,67 @@ async def start_stream_route(request: Request, stream_data: StartStreamRequest):
     if not stream_data.vod_urls:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Pelo menos um VOD deve ser selecionado para iniciar a transmissão.")
 
-    if user_id in active_streams and active_streams[user_id].poll() is None:
+    # Checagem e criação da tarefa sem await no meio: duas requisições simultâneas
+    # não conseguem iniciar dois FFmpeg para o mesmo usuário.
+    state = get_user_state(user_id)
+    if state.is_streaming():
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Uma transmissão já está ativa para este usuário.")
 
-    print(f"[{user_id}] Requisição para iniciar transmissão recebida.")
-    
-    threading.Thread(target=stream_vods_thread, args=(
+    logger.info("[%s] Requisição para iniciar transmissão recebida.", user_id)
+
+    state.task = asyncio.create_task(stream_vods_task(
+        state,
         user_id,
         stream_data.vod_urls,
         stream_data.quality,
         stream_data.stream_key
-    ), daemon=True).start()
+    ))
 
-    return JSONResponse(content={"message": "Iniciando transmissão em segundo plano. Verifique o status."})
+    return {"message": "Iniciando transmissão em segundo plano. Verifique o status."}
 
 @app.post("/api/stream/stop")
-async def stop_stream_route(request: Request):
-    user_id = request.session.get('user_id')
-
-    if not user_id:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Não autenticado. Faça login.")
+async def stop_stream_route(user: CurrentUser = Depends(get_current_user)):
+    user_id = user.user_id
 
-    if user_id not in active_streams:
+    state = users.get(user_id)
+    if state is None or state.task is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Nenhuma transmissão ativa encontrada para este usuário.")
 
-    ffmpeg_process_to_kill = active_streams.pop(user_id)
-    user_stream_status[user_id] = {"status": "Parando...", "current_vod": "Nenhum"}
+    task, proc = state.task, state.proc
+    state.task = state.proc = None
+    state.set_status("Parando...", "Nenhum")
 
-    if ffmpeg_process_to_kill.poll() is None:
-        print(f"[{user_id}] Encerrando transmissão. PID do FFmpeg: {ffmpeg_process_to_kill.pid}")
+    if not task.done():
         try:
-            ffmpeg_process_to_kill.terminate()
-            print(f"[{user_id}] Sinal de terminação enviado ao FFmpeg.")
-            user_stream_status[user_id] = {"status": "Parado", "current_vod": "Nenhum"}
-            return JSONResponse(content={"message": "Sinal de encerramento enviado. Verifique o status."})
+            await terminate_stream(user_id, task, proc)
+            logger.info("[%s] Transmissão encerrada.", user_id)
+            state.set_status("Parado", "Nenhum")
+            return {"message": "Transmissão encerrada."}
         except Exception as e:
-            print(f"[{user_id}] Erro ao encerrar processo: {e}")
-            user_stream_status[user_id] = {"status": "Erro", "current_vod": f"Erro ao encerrar: {str(e)}"}
+            logger.exception("[%s] Erro ao encerrar processo: %s", user_id, e)
+            state.set_status("Erro", f"Erro ao encerrar: {str(e)}")
             raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Erro ao encerrar transmissão: {str(e)}")
     else:
-        print(f"[{user_id}] Processo já não estava rodando ao tentar encerrar.")
-        user_stream_status[user_id] = {"status": "Parado", "current_vod": "Nenhum"}
-        return JSONResponse(content={"message": "Transmissão já estava inativa."})
\ No newline at end of file
+        logger.info("[%s] Processo já não estava rodando ao tentar encerrar.", user_id)
+        state.set_status("Parado", "Nenhum")
+        return {"message": "Transmissão já estava inativa."}
+
+
+# --- EXECUÇÃO DIRETA ---
+# Equivalente em linha de comando (a partir da pasta backend):
+#   uvicorn main:app --port 5000 --loop uvloop --http httptools
+# httptools vem com uvicorn[standard]. Mantenha um único worker: o estado das
+# transmissões (processos FFmpeg, status) fica na memória deste processo.
+# No Windows com --reload o uvicorn usa o SelectorEventLoop, que não cria subprocessos;
+# nesse caso o FFmpeg roda via Popen (ver spawn_ffmpeg).
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(
+        "main:app",
+        host="127.0.0.1",
+        port=5000,
+        # Sem uvloop (Windows ou não instalado) o uvicorn usa o loop padrão do asyncio
+        loop="uvloop" if uvloop is not None else "asyncio",
+        http="httptools",
+    )